@@ -19,5 +19,6 @@ err=0
 trap 'err=1' ERR
 
 pytest lib/test
+pytest onnx_serve/test
 
 test $err = 0
@@ -61,7 +61,12 @@ def debug_obj(name, payload, debug):
     if not debug:
         return
 
-    cx_logger().info("{}: {}".format(name, stringify.truncate(payload)))
+    logger = cx_logger()
+    # stringifying large payloads is expensive, so skip it if the record would be discarded
+    if not logger.isEnabledFor(logging.DEBUG):
+        return
+
+    logger.debug("{}: {}".format(name, stringify.truncate(payload)))
 
 
 refresh_logger()
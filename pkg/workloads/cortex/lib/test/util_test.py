@@ -12,6 +12,7 @@
 # See the License for the specific language governing permissions and
 # limitations under the License.
 
+import os
 from copy import deepcopy
 import pytest
 
@@ -64,3 +65,21 @@ def test_is_number_col():
     assert util.is_number_col([None, 1, None])
     assert util.is_number_col([None, 1.1, None])
     assert not util.is_number_col([None, None, None])
+
+
+def test_available_cpus(monkeypatch):
+    cgroup_files = {
+        "/sys/fs/cgroup/cpu/cpu.cfs_quota_us": "200000",
+        "/sys/fs/cgroup/cpu/cpu.cfs_period_us": "100000",
+    }
+    monkeypatch.setattr(util, "read_file_strip", lambda path: cgroup_files.get(path))
+    assert util.available_cpus() == 2
+
+    cgroup_files["/sys/fs/cgroup/cpu/cpu.cfs_quota_us"] = "50000"
+    assert util.available_cpus() == 1
+
+    cgroup_files["/sys/fs/cgroup/cpu/cpu.cfs_quota_us"] = "-1"
+    assert util.available_cpus() == os.cpu_count()
+
+    cgroup_files.clear()
+    assert util.available_cpus() == os.cpu_count()
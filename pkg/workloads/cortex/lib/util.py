@@ -533,3 +533,16 @@ def has_function(impl, fn_name):
         return False
 
     return callable(fn)
+
+
+def available_cpus():
+    # cgroup cpu limit if one is set, otherwise all cpus on the node
+    quota = read_file_strip("/sys/fs/cgroup/cpu/cpu.cfs_quota_us")
+    period = read_file_strip("/sys/fs/cgroup/cpu/cpu.cfs_period_us")
+    try:
+        if int(quota) > 0 and int(period) > 0:
+            return max(1, int(quota) // int(period))
+    except (TypeError, ValueError):
+        pass
+
+    return os.cpu_count() or 1
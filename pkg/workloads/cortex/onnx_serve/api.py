@@ -14,12 +14,16 @@
 
 import sys
 import os
+import json
 import argparse
 import time
 
+import numpy as np
+import orjson
 from flask import Flask, request, jsonify, g
 from flask_api import status
-from waitress import serve
+from gunicorn.app.base import BaseApplication
+from gunicorn.config import Config
 
 from cortex.lib import util, Context, api_utils
 from cortex.lib.log import cx_logger, debug_obj, refresh_logger
@@ -68,10 +72,21 @@ def after_request(response):
 def predict():
     debug = request.args.get("debug", "false").lower() == "true"
 
-    try:
-        payload = request.get_json()
-    except:
-        return "malformed json", status.HTTP_400_BAD_REQUEST
+    body = request.get_data(cache=False)
+    if request.mimetype == "application/octet-stream":
+        try:
+            payload = tensor_from_bytes(body, request.headers)
+        except ValueError as e:
+            return "malformed tensor: {}".format(e), status.HTTP_400_BAD_REQUEST
+    else:
+        try:
+            payload = orjson.loads(body) if len(body) > 0 else None
+        except orjson.JSONDecodeError:
+            # orjson is strict about NaN, Infinity and integers that don't fit in 64 bits
+            try:
+                payload = json.loads(body)
+            except ValueError:
+                return "malformed json", status.HTTP_400_BAD_REQUEST
 
     api = local_cache["api"]
     predictor = local_cache["predictor"]
@@ -89,7 +104,21 @@ def predict():
         return prediction_failed(str(e))
 
     g.prediction = output
-    return jsonify(output)
+    return json_response(output)
+
+
+def tensor_from_bytes(body, headers):
+    # a single little-endian tensor, described by headers; the array is a view of the body
+    if headers.get("X-Cortex-Dtype") is None or headers.get("X-Cortex-Shape") is None:
+        raise ValueError('"X-Cortex-Dtype" and "X-Cortex-Shape" headers are required')
+
+    try:
+        dtype = np.dtype(headers["X-Cortex-Dtype"]).newbyteorder("<")
+    except TypeError as e:
+        raise ValueError(str(e)) from e
+
+    shape = tuple(int(dim) for dim in headers["X-Cortex-Shape"].split(","))
+    return np.frombuffer(body, dtype=dtype).reshape(shape)
 
 
 def prediction_failed(reason):
@@ -104,7 +133,16 @@ def get_summary():
         "model_signature": local_cache["client"].input_signature,
         "message": api_utils.API_SUMMARY_MESSAGE,
     }
-    return jsonify(response)
+    return json_response(response)
+
+
+def json_response(obj):
+    try:
+        body = orjson.dumps(obj, option=orjson.OPT_SERIALIZE_NUMPY | orjson.OPT_SORT_KEYS)
+    except TypeError:
+        # orjson doesn't support some types that json_tricks does (e.g. sets, non-string keys)
+        return jsonify(obj)
+    return app.response_class(body, mimetype="application/json")
 
 
 @app.errorhandler(Exception)
@@ -113,24 +151,48 @@ def exceptions(e):
     return jsonify(error=str(e)), 500
 
 
-def start(args):
-    api = None
-    try:
-        ctx = Context(s3_path=args.context, cache_dir=args.cache_dir, workload_id=args.workload_id)
-        api = ctx.apis_id_map[args.api]
-        local_cache["api"] = api
-        local_cache["ctx"] = ctx
+class GunicornApplication(BaseApplication):
+    def __init__(self, app, options):
+        self.application = app
+        self.options = options
+        super().__init__()
 
-        if api["predictor"]["type"] != "onnx":
-            raise CortexException(api["name"], "predictor type is not onnx")
+    def load_config(self):
+        for key, value in self.options.items():
+            self.cfg.set(key, value)
+
+    def load(self):
+        return self.application
+
+
+def validate_gunicorn_options(options):
+    # gunicorn exits without logging on invalid parameters, so they are checked beforehand
+    cfg = Config()
+    for key, value in options.items():
+        if key not in cfg.settings:
+            raise UserException("predictor config", "unknown gunicorn parameter", key)
+        try:
+            cfg.set(key, value)
+        except (TypeError, ValueError) as e:
+            raise UserException("predictor config", "gunicorn parameter " + key, str(e)) from e
+
+
+def load_predictor(worker):
+    # the ONNX runtime session isn't fork-safe, so it's created in each worker after forking
+    api = local_cache["api"]
+    ctx = local_cache["ctx"]
 
+    try:
         cx_logger().info("loading the predictor from {}".format(api["predictor"]["path"]))
 
-        _, prefix = ctx.storage.deconstruct_s3_path(api["predictor"]["model"])
-        model_path = os.path.join(args.model_dir, os.path.basename(prefix))
-        local_cache["client"] = ONNXClient(model_path)
+        local_cache["client"] = ONNXClient(
+            local_cache["model_path"],
+            local_cache["intra_op_num_threads"],
+            trt_cache_dir=local_cache["trt_cache_dir"],
+            trt_fp16=os.environ.get("CORTEX_TRT_FP16", "true").lower() != "false",
+        )
 
-        predictor_class = ctx.get_predictor_class(api["name"], args.project_dir)
+        predictor_class = ctx.get_predictor_class(api["name"], local_cache["project_dir"])
 
         try:
             local_cache["predictor"] = predictor_class(
@@ -140,6 +202,65 @@ def start(args):
             raise UserRuntimeException(api["predictor"]["path"], "__init__", str(e)) from e
         finally:
             refresh_logger()
+    except:
+        # raising before the worker has booted stops gunicorn
+        cx_logger().exception("failed to start api")
+        raise
+
+    cx_logger().info("ONNX model signature: {}".format(local_cache["client"].input_signature))
+    cx_logger().info("{} api is live".format(api["name"]))
+    open("/health_check.txt", "a").close()
+
+
+def start(args):
+    api = None
+    try:
+        ctx = Context(s3_path=args.context, cache_dir=args.cache_dir, workload_id=args.workload_id)
+        api = ctx.apis_id_map[args.api]
+        local_cache["api"] = api
+        local_cache["ctx"] = ctx
+
+        if api["predictor"]["type"] != "onnx":
+            raise CortexException(api["name"], "predictor type is not onnx")
+
+        _, prefix = ctx.storage.deconstruct_s3_path(api["predictor"]["model"])
+        local_cache["model_path"] = os.path.join(args.model_dir, os.path.basename(prefix))
+        local_cache["project_dir"] = args.project_dir
+        local_cache["trt_cache_dir"] = os.path.join(args.cache_dir, "trt_engines")
+
+        gunicorn_options = {}
+        if api["predictor"].get("config") is not None:
+            for key, value in api["predictor"]["config"].items():
+                if key.startswith("gunicorn_"):
+                    gunicorn_options[key[len("gunicorn_") :]] = value
+                elif key.startswith("waitress_"):
+                    # the api used to be served by waitress
+                    cx_logger().warn("{} is ignored, use gunicorn_ parameters instead".format(key))
+
+        if len(gunicorn_options) > 0:
+            cx_logger().info("gunicorn parameters: {}".format(gunicorn_options))
+            validate_gunicorn_options(gunicorn_options)
+
+        # split the available cpus between the workers so that their thread pools don't compete
+        cpus = util.available_cpus()
+        intra_op_num_threads = os.environ.get("CORTEX_INTRA_THREADS")
+        if intra_op_num_threads is not None:
+            try:
+                intra_op_num_threads = int(intra_op_num_threads)
+            except ValueError as e:
+                raise UserException("CORTEX_INTRA_THREADS must be an integer") from e
+        if "workers" not in gunicorn_options:
+            gunicorn_options["workers"] = max(1, cpus // (intra_op_num_threads or cpus))
+        if intra_op_num_threads is None:
+            intra_op_num_threads = max(1, cpus // max(1, int(gunicorn_options["workers"])))
+        local_cache["intra_op_num_threads"] = intra_op_num_threads
+
+        gunicorn_options.setdefault("worker_class", "gthread")
+        gunicorn_options.setdefault("threads", 2)
+        # loading the model can take longer than gunicorn's default worker timeout
+        gunicorn_options.setdefault("timeout", 0)
+        gunicorn_options["bind"] = "0.0.0.0:{}".format(args.port)
+        gunicorn_options["post_worker_init"] = load_predictor
     except Exception as e:
         cx_logger().exception("failed to start api")
         sys.exit(1)
@@ -150,22 +271,7 @@ def start(args):
         except Exception as e:
             cx_logger().warn("an error occurred while attempting to load classes", exc_info=True)
 
-    cx_logger().info("ONNX model signature: {}".format(local_cache["client"].input_signature))
-
-    waitress_kwargs = {}
-    if api["predictor"].get("config") is not None:
-        for key, value in api["predictor"]["config"].items():
-            if key.startswith("waitress_"):
-                waitress_kwargs[key[len("waitress_") :]] = value
-
-    if len(waitress_kwargs) > 0:
-        cx_logger().info("waitress parameters: {}".format(waitress_kwargs))
-
-    waitress_kwargs["listen"] = "*:{}".format(args.port)
-
-    cx_logger().info("{} api is live".format(api["name"]))
-    open("/health_check.txt", "a").close()
-    serve(app, **waitress_kwargs)
+    GunicornApplication(app, gunicorn_options).run()
 
 
 def main():
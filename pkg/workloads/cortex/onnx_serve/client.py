@@ -12,6 +12,10 @@
 # See the License for the specific language governing permissions and
 # limitations under the License.
 
+import ctypes.util
+import threading
+
+import onnx
 import onnxruntime as rt
 import numpy as np
 
@@ -21,14 +25,41 @@ from cortex.lib.exceptions import CortexException, UserException
 
 
 class ONNXClient:
-    def __init__(self, model_path):
+    def __init__(self, model_path, intra_op_num_threads=None, trt_cache_dir=None, trt_fp16=True):
         """Setup ONNX runtime session.
 
         Args:
             model_path (string): Path to model in local file system.
+            intra_op_num_threads (int): Number of threads used to run each operator (defaults to the number of CPUs available to the container).
+            trt_cache_dir (string): Directory in which to cache TensorRT engines (if TensorRT is available).
+            trt_fp16 (bool): Whether TensorRT may use FP16 kernels (if TensorRT is available).
         """
         self._model_path = model_path
-        session = rt.InferenceSession(model_path)
+
+        if intra_op_num_threads is None:
+            intra_op_num_threads = util.available_cpus()
+
+        sess_options = rt.SessionOptions()
+        sess_options.graph_optimization_level = rt.GraphOptimizationLevel.ORT_ENABLE_ALL
+        sess_options.execution_mode = rt.ExecutionMode.ORT_SEQUENTIAL
+        sess_options.intra_op_num_threads = intra_op_num_threads
+        sess_options.inter_op_num_threads = 1
+        sess_options.add_session_config_entry("session.disable_prepacking", "0")
+
+        # cuDNN benchmarks convolution algorithms again for every new input shape, so the exhaustive
+        # search is only used when all input shapes are fixed (it's then paid once, during warmup)
+        cudnn_conv_algo_search = "HEURISTIC"
+        if "CUDAExecutionProvider" in rt.get_available_providers():
+            if has_static_input_shapes(model_path):
+                cudnn_conv_algo_search = "EXHAUSTIVE"
+
+        session = rt.InferenceSession(
+            model_path,
+            sess_options=sess_options,
+            providers=execution_providers(trt_cache_dir, trt_fp16, cudnn_conv_algo_search),
+        )
+
+        cx_logger().info("onnxruntime execution providers: {}".format(session.get_providers()))
 
         self._session = session
         self._signature = session.get_inputs()
@@ -39,6 +70,41 @@ class ONNXClient:
 
         self._input_signature = metadata
 
+        # resolved once so that the dtype and shape lookups aren't repeated for every payload
+        self._input_specs = []
+        for meta in self._signature:
+            if meta.type not in ONNX_TO_NP_TYPE:
+                raise UserException(
+                    'input "{}" has unsupported type "{}"'.format(meta.name, meta.type)
+                )
+            target_dtype = np.dtype(ONNX_TO_NP_TYPE[meta.type])
+            # dynamic dimensions are either None or named (e.g. "batch_size")
+            target_shape = tuple(dim if type(dim) is int else 1 for dim in meta.shape)
+            self._input_specs.append((meta.name, target_dtype, target_shape))
+
+        # samples can only be stacked into a single run if every input and output is batch-leading
+        batch_dims = [
+            meta.shape[0] if len(meta.shape) > 0 else 0
+            for meta in self._signature + session.get_outputs()
+        ]
+        # differently named first dimensions (e.g. "N" and "M") aren't the same batch dimension
+        self._batchable = (
+            all(type(dim) is not int for dim in batch_dims)
+            and len(set(dim for dim in batch_dims if type(dim) is str)) <= 1
+        )
+        # when batching, each payload may contain any number of samples along the first axis
+        batch_input_specs = [
+            (name, dtype, (-1,) + shape[1:]) for name, dtype, shape in self._input_specs
+        ]
+        self._convert_input = make_input_converter(self._input_specs)
+        self._convert_batch_input = make_input_converter(batch_input_specs)
+
+        # only one inference runs at a time so that it has the session's thread pool to itself, while
+        # other threads parse and serialize their payloads (ONNX runtime releases the GIL while running)
+        self._run_lock = threading.Lock()
+
+        self._warm_up()
+
     def predict(self, payload):
         """Validate payload, convert payload to a dictionary of input_name to numpy.ndarray and make a prediction.
 
@@ -48,10 +114,59 @@ class ONNXClient:
         Returns:
             numpy.ndarray: Prediction
         """
-        inference_input = convert_to_onnx_input(payload, self._signature)
-        model_output = self._session.run([], inference_input)
+        inference_input = self._convert_input(payload)
+        with self._run_lock:
+            model_output = self._session.run([], inference_input)
         return model_output
 
+    def predict_batch(self, payloads):
+        """Validate payloads, concatenate them along the first axis and make a single prediction for all of them.
+
+        Each payload may contain several samples along the first axis. If the model's inputs or outputs don't have a dynamic first dimension, a prediction is made for each payload separately.
+
+        Args:
+            payloads (list): Inputs to model, one per sample
+
+        Returns:
+            list: Prediction for each payload, in the same format as returned by predict()
+        """
+        if len(payloads) == 0:
+            return []
+
+        if not self._batchable:
+            return [self.predict(payload) for payload in payloads]
+
+        inference_input, batch_sizes = convert_to_batched_onnx_input(
+            payloads, self._convert_batch_input
+        )
+        with self._run_lock:
+            model_outputs = self._session.run([], inference_input)
+
+        # a dynamic first dimension isn't necessarily the batch dimension (e.g. flattened outputs)
+        if any(len(model_output) != sum(batch_sizes) for model_output in model_outputs):
+            return [self.predict(payload) for payload in payloads]
+
+        # np.split returns views, so no output data is copied
+        split_indices = np.cumsum(batch_sizes)[:-1]
+        split_outputs = [np.split(model_output, split_indices) for model_output in model_outputs]
+        return [list(prediction) for prediction in zip(*split_outputs)]
+
+    def _warm_up(self):
+        # ONNX runtime defers kernel selection, weight prepacking and memory allocation to the first
+        # run, so that cost is moved from the first request to startup; the second run is steady-state
+        warmup_input = {}
+        for name, dtype, shape in self._input_specs:
+            if dtype == np.object_:
+                warmup_input[name] = np.full(shape, "", dtype=dtype)
+            else:
+                warmup_input[name] = np.zeros(shape, dtype=dtype)
+
+        try:
+            for _ in range(2):
+                self._session.run([], warmup_input)
+        except Exception as e:
+            cx_logger().warn("unable to warm up the model with zero inputs", exc_info=True)
+
     @property
     def session(self):
         return self._session
@@ -61,6 +176,44 @@ class ONNXClient:
         return self._input_signature
 
 
+def execution_providers(trt_cache_dir, trt_fp16, cudnn_conv_algo_search):
+    available_providers = rt.get_available_providers()
+    providers = []
+    # the TensorRT provider is built into the onnxruntime-gpu wheel, but TensorRT itself may not be
+    # installed, in which case onnxruntime drops the CUDA provider options when it falls back
+    if "TensorrtExecutionProvider" in available_providers and ctypes.util.find_library("nvinfer"):
+        trt_options = {"trt_fp16_enable": "1" if trt_fp16 else "0"}
+        if trt_cache_dir is not None:
+            # building an engine can take minutes, so built engines are reused across restarts
+            util.mkdir_p(trt_cache_dir)
+            trt_options["trt_engine_cache_enable"] = "1"
+            trt_options["trt_engine_cache_path"] = trt_cache_dir
+        providers.append(("TensorrtExecutionProvider", trt_options))
+    if "CUDAExecutionProvider" in available_providers:
+        cuda_options = {
+            "cudnn_conv_algo_search": cudnn_conv_algo_search,
+            "do_copy_in_default_stream": "1",
+        }
+        providers.append(("CUDAExecutionProvider", cuda_options))
+    providers.append("CPUExecutionProvider")
+    return providers
+
+
+def has_static_input_shapes(model_path):
+    # the shapes are read from the model file since they're needed before the session is created
+    model = onnx.load(model_path, load_external_data=False)
+    initializer_names = set(initializer.name for initializer in model.graph.initializer)
+    for graph_input in model.graph.input:
+        # older models also list their initializers as inputs
+        if graph_input.name in initializer_names:
+            continue
+        if not graph_input.type.tensor_type.HasField("shape"):
+            return False
+        if not all(dim.HasField("dim_value") for dim in graph_input.type.tensor_type.shape.dim):
+            return False
+    return True
+
+
 # https://github.com/microsoft/onnxruntime/blob/v0.4.0/onnxruntime/python/onnxruntime_pybind_mlvalue.cc
 ONNX_TO_NP_TYPE = {
     "tensor(float16)": "float16",
@@ -79,65 +232,86 @@ ONNX_TO_NP_TYPE = {
 }
 
 
-def transform_to_numpy(input_pyobj, input_metadata):
-    target_dtype = ONNX_TO_NP_TYPE[input_metadata.type]
-    target_shape = input_metadata.shape
-
+def transform_to_numpy(input_pyobj, target_dtype, target_shape):
     try:
-        for idx, dim in enumerate(target_shape):
-            if type(dim) is not int:
-                target_shape[idx] = 1
-
         if type(input_pyobj) is np.ndarray:
             np_arr = input_pyobj
-            if np.issubdtype(np_arr.dtype, np.number) == np.issubdtype(target_dtype, np.number):
-                if str(np_arr.dtype) != target_dtype:
-                    np_arr = np_arr.astype(target_dtype)
-            else:
+            if np.issubdtype(np_arr.dtype, np.number) != np.issubdtype(target_dtype, np.number):
                 raise ValueError(
                     "expected dtype '{}' but found '{}'".format(target_dtype, np_arr.dtype)
                 )
+            # no-op for contiguous arrays of the right dtype (e.g. from pre-processing or binary
+            # payloads), which ONNX runtime can then read without copying
+            np_arr = np.ascontiguousarray(np_arr, dtype=target_dtype).reshape(target_shape)
         else:
-            np_arr = np.array(input_pyobj, dtype=target_dtype)
-        np_arr = np_arr.reshape(target_shape)
+            np_arr = np.asarray(input_pyobj, dtype=target_dtype).reshape(target_shape)
         return np_arr
     except Exception as e:
         raise UserException("failed to convert to numpy array", str(e)) from e
 
 
-def convert_to_onnx_input(payload, input_metadata_list):
-    input_dict = {}
-    if len(input_metadata_list) == 1:
-        input_metadata = input_metadata_list[0]
-        if util.is_dict(payload):
-            if payload.get(input_metadata.name) is None:
-                raise UserException('missing key "{}"'.format(input_metadata.name))
-            input_dict[input_metadata.name] = transform_to_numpy(
-                payload[input_metadata.name], input_metadata
-            )
-        else:
-            try:
-                input_dict[input_metadata.name] = transform_to_numpy(payload, input_metadata)
-            except CortexException as e:
-                e.wrap('key "{}"'.format(input_metadata.name))
-                raise
-    else:
-        for input_metadata in input_metadata_list:
+def convert_to_batched_onnx_input(payloads, convert_input):
+    input_dicts = []
+    batch_sizes = []
+    for idx, payload in enumerate(payloads):
+        try:
+            input_dict = convert_input(payload)
+            sizes = set(np_arr.shape[0] for np_arr in input_dict.values())
+            if len(sizes) > 1:
+                raise UserException("inputs have different sizes along the first dimension")
+        except CortexException as e:
+            e.wrap("payload {}".format(idx))
+            raise
+        input_dicts.append(input_dict)
+        batch_sizes.append(sizes.pop())
+
+    batched_input = {
+        name: np.concatenate([input_dict[name] for input_dict in input_dicts])
+        for name in input_dicts[0]
+    }
+    return batched_input, batch_sizes
+
+
+# returns a function that converts a payload to a dictionary of input name to numpy.ndarray for
+# input_specs, so that nothing that only depends on the model is re-evaluated per call
+def make_input_converter(input_specs):
+    if len(input_specs) != 1:
+        expected_keys_message = "expected payload to be a dictionary with keys {}".format(
+            ", ".join('"' + spec[0] + '"' for spec in input_specs)
+        )
+
+        def convert_inputs(payload):
             if not util.is_dict(payload):
-                expected_keys = [metadata.name for metadata in input_metadata_list]
-                raise UserException(
-                    "expected payload to be a dictionary with keys {}".format(
-                        ", ".join('"' + key + '"' for key in expected_keys)
-                    )
-                )
+                raise UserException(expected_keys_message)
 
-            if payload.get(input_metadata.name) is None:
-                raise UserException('missing key "{}"'.format(input_metadata.name))
-            try:
-                input_dict[input_metadata.name] = transform_to_numpy(
-                    payload[input_metadata.name], input_metadata
-                )
-            except CortexException as e:
-                e.wrap('key "{}"'.format(input_metadata.name))
-                raise
-    return input_dict
+            input_dict = {}
+            for name, target_dtype, target_shape in input_specs:
+                if payload.get(name) is None:
+                    raise UserException('missing key "{}"'.format(name))
+                try:
+                    input_dict[name] = transform_to_numpy(payload[name], target_dtype, target_shape)
+                except CortexException as e:
+                    e.wrap('key "{}"'.format(name))
+                    raise
+            return input_dict
+
+        return convert_inputs
+
+    name, target_dtype, target_shape = input_specs[0]
+    missing_key_message = 'missing key "{}"'.format(name)
+    key_message = 'key "{}"'.format(name)
+
+    def convert_single_input(payload):
+        if util.is_dict(payload):
+            input_pyobj = payload.get(name)
+            if input_pyobj is None:
+                raise UserException(missing_key_message)
+            return {name: transform_to_numpy(input_pyobj, target_dtype, target_shape)}
+
+        try:
+            return {name: transform_to_numpy(payload, target_dtype, target_shape)}
+        except CortexException as e:
+            e.wrap(key_message)
+            raise
+
+    return convert_single_input
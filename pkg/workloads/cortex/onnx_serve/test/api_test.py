@@ -0,0 +1,163 @@
+# Copyright 2019 Cortex Labs, Inc.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import argparse
+import json
+
+import numpy as np
+import pytest
+
+from cortex.lib.exceptions import UserException
+from cortex.onnx_serve import api
+
+
+def test_json_response():
+    with api.app.app_context():
+        response = api.json_response({"b": [np.array([1.5, 2], dtype=np.float32)], "a": None})
+        assert response.mimetype == "application/json"
+        assert response.get_data() == b'{"a":null,"b":[[1.5,2.0]]}'
+
+        # orjson only supports string keys
+        response = api.json_response({1: "one"})
+        assert response.mimetype == "application/json"
+        assert json.loads(response.get_data()) == {"1": "one"}
+
+
+def test_validate_gunicorn_options():
+    api.validate_gunicorn_options({"workers": "2", "threads": 4, "timeout": 0})
+
+    with pytest.raises(UserException, match="unknown gunicorn parameter: worker"):
+        api.validate_gunicorn_options({"worker": 2})
+    with pytest.raises(UserException, match="gunicorn parameter workers"):
+        api.validate_gunicorn_options({"workers": "x"})
+    with pytest.raises(UserException, match="gunicorn parameter timeout"):
+        api.validate_gunicorn_options({"timeout": -1})
+
+
+class MockContext:
+    def __init__(self, predictor_config):
+        api = {
+            "name": "test",
+            "predictor": {
+                "type": "onnx",
+                "model": "s3://bucket/model.onnx",
+                "config": predictor_config,
+            },
+            "tracker": None,
+        }
+        self.apis_id_map = {"test": api}
+        self.storage = self
+
+    def deconstruct_s3_path(self, s3_path):
+        return "bucket", "model.onnx"
+
+
+def test_start_invalid_config(monkeypatch, tmp_path):
+    args = argparse.Namespace(
+        context="s3://bucket/context.json",
+        cache_dir=str(tmp_path),
+        workload_id="workload",
+        api="test",
+        model_dir=str(tmp_path),
+        project_dir=str(tmp_path),
+        port=8888,
+    )
+    monkeypatch.setattr(api.GunicornApplication, "run", lambda self: None)
+
+    def start_error(predictor_config):
+        monkeypatch.setattr(api, "Context", lambda **kwargs: MockContext(predictor_config))
+        with pytest.raises(SystemExit) as excinfo:
+            api.start(args)
+        # the error that was logged before exiting
+        return excinfo.value.__context__
+
+    assert isinstance(start_error({"gunicorn_workers": "x"}), UserException)
+    assert isinstance(start_error({"gunicorn_bogus": 1}), UserException)
+
+    monkeypatch.setenv("CORTEX_INTRA_THREADS", "x")
+    assert isinstance(start_error({"gunicorn_workers": "2"}), UserException)
+
+    monkeypatch.setenv("CORTEX_INTRA_THREADS", "1")
+    monkeypatch.setattr(api, "Context", lambda **kwargs: MockContext({"gunicorn_workers": "2"}))
+    api.start(args)
+    assert api.local_cache["intra_op_num_threads"] == 1
+
+
+class EchoPredictor:
+    def predict(self, payload):
+        return payload
+
+
+@pytest.fixture
+def test_client(monkeypatch):
+    monkeypatch.setitem(api.local_cache, "api", {"name": "test", "predictor": {"path": "p.py"}})
+    monkeypatch.setitem(api.local_cache, "predictor", EchoPredictor())
+    monkeypatch.setattr(api.api_utils, "post_request_metrics", lambda *args: None)
+    return api.app.test_client()
+
+
+def test_predict_json(test_client):
+    response = test_client.post("/predict", data=b'{"x": [1, 2.5]}')
+    assert response.status_code == 200
+    assert json.loads(response.get_data()) == {"x": [1, 2.5]}
+
+    # NaN and Infinity are rejected by orjson but accepted by python's json module
+    response = test_client.post("/predict", data=b"[1, NaN, -Infinity]")
+    assert response.status_code == 200
+    assert json.loads(response.get_data()) == [1, None, None]
+
+    response = test_client.post("/predict", data=b"[1, 2")
+    assert response.status_code == 400
+
+
+def test_tensor_from_bytes():
+    body = np.arange(4, dtype="<f4").tobytes()
+
+    tensor = api.tensor_from_bytes(body, {"X-Cortex-Dtype": "float32", "X-Cortex-Shape": "2,2"})
+    assert tensor.dtype == np.float32
+    assert tensor.tolist() == [[0, 1], [2, 3]]
+
+    for headers in [
+        {"X-Cortex-Dtype": "float32"},
+        {"X-Cortex-Shape": "4"},
+        {"X-Cortex-Dtype": "not_a_dtype", "X-Cortex-Shape": "4"},
+        {"X-Cortex-Dtype": "object", "X-Cortex-Shape": "4"},
+        {"X-Cortex-Dtype": "float32", "X-Cortex-Shape": ""},
+        {"X-Cortex-Dtype": "float32", "X-Cortex-Shape": "2,x"},
+        {"X-Cortex-Dtype": "float32", "X-Cortex-Shape": "3"},
+        {"X-Cortex-Dtype": "float64", "X-Cortex-Shape": "4"},
+    ]:
+        with pytest.raises(ValueError):
+            api.tensor_from_bytes(body, headers)
+
+    with pytest.raises(ValueError):
+        api.tensor_from_bytes(body[:-1], {"X-Cortex-Dtype": "float32", "X-Cortex-Shape": "3"})
+
+
+def test_predict_binary(test_client):
+    headers = {"X-Cortex-Dtype": "int32", "X-Cortex-Shape": "1,3"}
+    body = np.array([1, 2, 3], dtype="<i4").tobytes()
+
+    response = test_client.post(
+        "/predict", data=body, headers=headers, content_type="application/octet-stream"
+    )
+    assert response.status_code == 200
+    assert json.loads(response.get_data()) == [[1, 2, 3]]
+
+    headers["X-Cortex-Shape"] = "2,2"
+    response = test_client.post(
+        "/predict", data=body, headers=headers, content_type="application/octet-stream"
+    )
+    assert response.status_code == 400
+    assert response.get_data().startswith(b"malformed tensor")
@@ -0,0 +1,129 @@
+# Copyright 2019 Cortex Labs, Inc.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import numpy as np
+import onnx
+from onnx import helper, TensorProto
+import pytest
+
+from cortex.lib.exceptions import UserException
+from cortex.onnx_serve.client import ONNXClient, has_static_input_shapes
+
+
+def float_tensor(name, shape):
+    return helper.make_tensor_value_info(name, TensorProto.FLOAT, shape)
+
+
+def make_model(tmp_path, nodes, inputs, outputs, initializers):
+    graph = helper.make_graph(nodes, "test", inputs, outputs, initializer=initializers)
+    model = helper.make_model(graph, opset_imports=[helper.make_opsetid("", 13)])
+    model.ir_version = 7
+    model_path = str(tmp_path / "model.onnx")
+    onnx.save(model, model_path)
+    return model_path
+
+
+def make_double_model(tmp_path, in_shape, out_shape):
+    two = helper.make_tensor("two", TensorProto.FLOAT, [1], [2.0])
+    nodes = [helper.make_node("Mul", ["x", "two"], ["y"])]
+    inputs = [float_tensor("x", in_shape)]
+    return make_model(tmp_path, nodes, inputs, [float_tensor("y", out_shape)], [two])
+
+
+def make_flatten_model(tmp_path, out_shape):
+    flat = helper.make_tensor("flat", TensorProto.INT64, [1], [-1])
+    nodes = [helper.make_node("Reshape", ["x", "flat"], ["y"])]
+    inputs = [float_tensor("x", ["N", 3])]
+    return make_model(tmp_path, nodes, inputs, [float_tensor("y", out_shape)], [flat])
+
+
+def test_predict(tmp_path):
+    client = ONNXClient(make_double_model(tmp_path, [1, 2], [1, 2]))
+    first = client.predict([1, 2])
+    second = client.predict({"x": np.array([[3, 4]])})
+
+    # predictions are independent of each other
+    assert first[0].tolist() == [[2, 4]]
+    assert second[0].tolist() == [[6, 8]]
+
+
+def test_predict_batch(tmp_path):
+    client = ONNXClient(make_double_model(tmp_path, ["N", 2], ["N", 2]))
+    predictions = client.predict_batch([[1, 2], [3, 4], np.array([5, 6])])
+
+    assert len(predictions) == 3
+    for prediction, expected in zip(predictions, [[[2, 4]], [[6, 8]], [[10, 12]]]):
+        assert len(prediction) == 1
+        assert prediction[0].tolist() == expected
+
+    assert client.predict_batch([]) == []
+
+
+def test_predict_batch_multi_sample_payloads(tmp_path):
+    client = ONNXClient(make_double_model(tmp_path, ["N", 2], ["N", 2]))
+    predictions = client.predict_batch([[[1, 1], [2, 2]], [3, 3], np.zeros((0, 2))])
+
+    assert predictions[0][0].tolist() == [[2, 2], [4, 4]]
+    assert predictions[1][0].tolist() == [[6, 6]]
+    assert predictions[2][0].shape == (0, 2)
+
+    with pytest.raises(UserException, match="payload 1"):
+        client.predict_batch([[1, 2], [1]])
+
+
+def test_predict_batch_fixed_batch_dimension(tmp_path):
+    client = ONNXClient(make_double_model(tmp_path, [1, 2], [1, 2]))
+    predictions = client.predict_batch([[1, 2], [3, 4]])
+
+    assert [prediction[0].tolist() for prediction in predictions] == [[[2, 4]], [[6, 8]]]
+
+
+@pytest.mark.parametrize("out_shape", [["M"], [None]])
+def test_predict_batch_non_batch_first_dimension(tmp_path, out_shape):
+    client = ONNXClient(make_flatten_model(tmp_path, out_shape))
+    predictions = client.predict_batch([[1, 2, 3], [4, 5, 6]])
+
+    assert [prediction[0].tolist() for prediction in predictions] == [[1, 2, 3], [4, 5, 6]]
+
+
+def test_predict_multiple_inputs(tmp_path):
+    nodes = [helper.make_node("Add", ["a", "b"], ["y"])]
+    inputs = [float_tensor("a", ["N", 2]), float_tensor("b", ["N", 2])]
+    client = ONNXClient(make_model(tmp_path, nodes, inputs, [float_tensor("y", ["N", 2])], []))
+
+    assert client.predict({"a": [1, 2], "b": [3, 4]})[0].tolist() == [[4, 6]]
+    predictions = client.predict_batch([{"a": [1, 2], "b": [3, 4]}, {"a": [[0, 0]], "b": [[1, 1]]}])
+    assert [prediction[0].tolist() for prediction in predictions] == [[[4, 6]], [[1, 1]]]
+
+    with pytest.raises(UserException, match='missing key "b"'):
+        client.predict({"a": [1, 2]})
+    with pytest.raises(UserException, match='keys "a", "b"'):
+        client.predict([1, 2])
+    with pytest.raises(UserException, match='payload 1: key "b"'):
+        client.predict_batch([{"a": [1, 2], "b": [3, 4]}, {"a": [1, 2], "b": [3]}])
+    with pytest.raises(UserException, match="different sizes"):
+        client.predict_batch([{"a": [[1, 2]], "b": [[3, 4], [5, 6]]}])
+
+
+def test_has_static_input_shapes(tmp_path):
+    assert has_static_input_shapes(make_double_model(tmp_path, [1, 2], [1, 2]))
+    assert not has_static_input_shapes(make_double_model(tmp_path, ["N", 2], ["N", 2]))
+    assert not has_static_input_shapes(make_double_model(tmp_path, [None, 2], [None, 2]))
+
+    # initializers that are listed as inputs aren't fed by payloads
+    two = helper.make_tensor("two", TensorProto.FLOAT, [1], [2.0])
+    nodes = [helper.make_node("Mul", ["x", "two"], ["y"])]
+    inputs = [float_tensor("x", [1, 2]), float_tensor("two", None)]
+    model_path = make_model(tmp_path, nodes, inputs, [float_tensor("y", [1, 2])], [two])
+    assert has_static_input_shapes(model_path)
@@ -14,6 +14,7 @@
 
 import os
 import sys
+import json
 import argparse
 import time
 
@@ -31,6 +32,8 @@ app.json_encoder = util.json_tricks_encoder
 
 local_cache = {"ctx": None, "api": None, "class_set": set()}
 
+HEALTH_RESPONSE_BODY = json.dumps({"ok": True})
+
 
 @app.before_request
 def before_request():
@@ -71,7 +74,8 @@ def prediction_failed(reason):
 
 @app.route("/healthz", methods=["GET"])
 def health():
-    return jsonify({"ok": True})
+    # the body is encoded once; the response isn't shared since after_request modifies its headers
+    return app.response_class(HEALTH_RESPONSE_BODY, mimetype="application/json")
 
 
 @app.route("/predict", methods=["POST"])